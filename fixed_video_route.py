@@ -1,20 +1,401 @@
 # FIXED Video Route - Replace your current video route with this
-@app.post("/detect/video/{classes}", response_class=StreamingResponse)
+
+# Extra imports used by this route (on top of your app's existing ones)
+import asyncio
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from fastapi.responses import FileResponse
+from ultralytics import YOLO
+from starlette.background import BackgroundTask
+
+# Shared with python-video-fix.py (video_encoding.py sits next to this file)
+from video_encoding import FFmpegPipeWriter, configure_opencv_threads, detect_h264_encoder
+
+# Optional: PyAV decodes with libavcodec's own frame/slice threading
+try:
+    import av
+    PYAV_AVAILABLE = True
+except ImportError:
+    PYAV_AVAILABLE = False
+
+OPENCV_PARALLEL = configure_opencv_threads()
+print(f"🧵 OpenCV: {cv2.getNumThreads()} threads ({OPENCV_PARALLEL})")
+
+# Probed once at startup rather than per request
+H264_ENCODER = detect_h264_encoder()
+print(f"🎞️ H.264 encoder: {H264_ENCODER or 'none (ffmpeg unavailable, using OpenCV)'}")
+
+# Frame source in order of preference: ffmpeg CLI (hwaccel) > PyAV > OpenCV
+DECODER = "ffmpeg" if H264_ENCODER else "pyav" if PYAV_AVAILABLE else "opencv"
+
+
+# Hardware decoder to pair with each encoder; ffmpeg falls back to software decode on its own
+HWACCELS = {"h264_nvenc": "cuda", "h264_qsv": "qsv"}
+
+
+class FFmpegPipeReader:
+    """cv2.VideoCapture look-alike that reads raw BGR frames from an ffmpeg decoder"""
+
+    def __init__(self, path: str, size, hwaccel: str = "auto"):
+        w, h = size
+        self.shape = (h, w, 3)
+        cmd = [
+            'ffmpeg', '-v', 'error',
+            '-hwaccel', hwaccel,
+            '-i', path,
+            '-an', '-sn', '-vsync', 'passthrough',
+            '-vf', f'crop={w}:{h}:0:0',  # drop the odd row/column like the PyAV/OpenCV paths do
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+            'pipe:1'
+        ]
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=w * h * 3 * 4)
+        self.eof = False
+
+    def isOpened(self) -> bool:
+        return not self.proc.stdout.closed
+
+    def read(self):
+        frame = np.empty(self.shape, dtype=np.uint8)
+        buf = memoryview(frame).cast("B")
+        filled = 0
+        while filled < len(buf):
+            n = self.proc.stdout.readinto(buf[filled:])
+            if not n:
+                self.eof = True
+                return False, None
+            filled += n
+        return True, frame
+
+    def release(self) -> bool:
+        """Stop the decoder; False if ffmpeg hit the end of its output by failing"""
+        if not self.eof and self.proc.poll() is None:
+            self.proc.kill()  # we stopped reading early, so its exit status means nothing
+            self.proc.stdout.close()
+            self.proc.wait()
+            return True
+        self.proc.stdout.close()
+        # EOF (or an early exit) means ffmpeg is done: a nonzero status is a truncated decode
+        return self.proc.wait() == 0
+
+
+# PyAV's counterclockwise display rotation (degrees) -> the cv2.rotate that undoes it
+PYAV_ROTATIONS = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_CLOCKWISE,
+}
+
+
+class PyAVReader:
+    """cv2.VideoCapture look-alike that decodes with PyAV using all cores"""
+
+    def __init__(self, path: str):
+        self.container = av.open(path)
+        stream = self.container.streams.video[0]
+        stream.thread_type = "AUTO"  # frame + slice threading inside libavcodec
+        self.frames = self.container.decode(stream)
+
+    def isOpened(self) -> bool:
+        return self.frames is not None
+
+    def read(self):
+        frame = next(self.frames, None)
+        if frame is None:
+            return False, None
+        image = frame.to_ndarray(format="bgr24")
+        # PyAV leaves the display matrix alone; rotate like OpenCV/ffmpeg so a portrait phone
+        # video matches the size CAP_PROP_FRAME_WIDTH/HEIGHT reported (older PyAV: no rotation)
+        rotate = PYAV_ROTATIONS.get(getattr(frame, "rotation", 0) % 360)
+        if rotate is not None:
+            image = cv2.rotate(image, rotate)
+        return True, image
+
+    def release(self):
+        self.frames = None
+        self.container.close()
+
+
+# Per-class box colors (BGR), indexed by class id
+BOX_COLORS = [
+    (56, 56, 255), (151, 157, 255), (31, 112, 255), (29, 178, 255),
+    (49, 210, 207), (10, 249, 72), (23, 204, 146), (134, 219, 61),
+    (52, 147, 26), (187, 212, 0), (168, 153, 44), (255, 194, 0),
+]
+
+
+def draw_detections_bgr(frame_bgr: np.ndarray, result, scale=(1.0, 1.0)) -> np.ndarray:
+    """
+    Draw one frame's detection boxes and labels onto it in place
+    `scale` maps box coordinates from the model input back to the frame
+    """
+    sx, sy = scale
+    for (x1, y1, x2, y2), cls, score in zip(
+        result.boxes.xyxy.tolist(),
+        result.boxes.cls.int().tolist(),
+        result.boxes.conf.tolist(),
+    ):
+        x1, y1, x2, y2 = int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy)
+        color = BOX_COLORS[cls % len(BOX_COLORS)]
+        label = f"{result.names[cls]} {score:.2f}"
+        cv2.rectangle(frame_bgr, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(frame_bgr, label, (x1, max(y1 - 6, 12)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+
+    return frame_bgr
+
+
+# Batched detector input: long side in pixels, short side rounded up to the model stride
+INFER_LONG_SIDE = 640
+MODEL_STRIDE = 32
+DEFAULT_BATCH_SIZE = 8  # the route's batch_size default, also used for the warm-up
+MAX_BATCH_SIZE = 32  # cap on the route's batch_size parameter
+
+
+def infer_size(w: int, h: int):
+    """Model input size closest to the frame's aspect ratio, in multiples of the stride"""
+    scale = INFER_LONG_SIDE / max(w, h)
+    return tuple(max(MODEL_STRIDE, -(-round(d * scale) // MODEL_STRIDE) * MODEL_STRIDE) for d in (w, h))
+
+
+# Near-duplicate detection: frames are compared as tiny thumbnails, and a frame where no
+# thumbnail pixel moved more than this from the last detected frame reuses its boxes (0 = off).
+# The max (not the mean) keeps small objects visible: a person a few thumbnail pixels wide
+# walking through a static scene still trips it
+DEDUP_THUMB_SIZE = (32, 18)
+DEDUP_MAX_PIXEL_DIFF = 12
+# Run the model at least this often anyway, so reused boxes never go stale for long
+DEDUP_MAX_SKIP = 15
+
+
+def video_detector_weights() -> str:
+    """The weights your app's own YOLO `model` was loaded from, else $YOLO_WEIGHTS"""
+    host_model = globals().get("model")
+    return getattr(host_model, "ckpt_path", None) or os.environ.get("YOLO_WEIGHTS", "yolov8n.pt")
+
+
+@app.on_event("startup")
+def load_video_detector():
+    """
+    Load, fuse and warm up this route's detector once per process so the first request runs
+    at full speed; kept on app.state so your app's own `model` is left alone
+    """
+    # Batches always have the same input shape, so let cuDNN benchmark and keep the fastest kernels
+    torch.backends.cudnn.benchmark = True
+
+    weights = video_detector_weights()
+    detector = YOLO(weights)
+    if torch.cuda.is_available():
+        detector.to("cuda:0")
+    detector.fuse()
+
+    # Warm-up pass at the route's default 16:9 batch shape (CUDA context, cuDNN autotune,
+    # lazy init), so cuDNN picks its kernels for the batch requests actually send
+    w, h = infer_size(1280, 720)
+    detector(torch.zeros((DEFAULT_BATCH_SIZE, 3, h, w)), verbose=False)
+    app.state.video_detector = detector
+    print(f"🧠 Video detector ready: {weights} on {detector.device}")
+
+
+class BatchDetector:
+    """
+    Batched detector that skips inference on frames nearly identical to the last frame
+    it actually ran on, drawing that frame's detections instead
+    """
+
+    def __init__(self, ids, conf: float, max_pixel_diff: int = DEDUP_MAX_PIXEL_DIFF,
+                 max_skip: int = DEDUP_MAX_SKIP):
+        self.ids = ids
+        self.conf = conf
+        self.max_pixel_diff = max_pixel_diff
+        self.max_skip = max_skip
+        self.since_key = 0  # frames reused since the model last ran
+        self.key_thumb = None
+        self.last_result = None
+        self.skipped = 0
+        self.blob_size = None
+        self.box_scale = (1.0, 1.0)
+
+    def _is_new(self, frame_bgr: np.ndarray) -> bool:
+        if self.max_pixel_diff <= 0:
+            return True
+        thumb = cv2.resize(frame_bgr, DEDUP_THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        if (self.key_thumb is not None and self.since_key < self.max_skip
+                and cv2.norm(thumb, self.key_thumb, cv2.NORM_INF) <= self.max_pixel_diff):
+            self.since_key += 1
+            return False
+        self.key_thumb = thumb
+        self.since_key = 0
+        return True
+
+    def detect_and_draw(self, frames_bgr: list) -> list:
+        """Run one batched forward pass over the frames that need it, preserving order"""
+        is_new = [self._is_new(f) for f in frames_bgr]
+        fresh = [f for f, new in zip(frames_bgr, is_new) if new]
+        fresh_results = iter(self._infer(fresh) if fresh else ())
+
+        processed = []
+        for frame_bgr, new in zip(frames_bgr, is_new):
+            if new:
+                self.last_result = next(fresh_results)
+            else:
+                self.skipped += 1
+            processed.append(draw_detections_bgr(frame_bgr, self.last_result, self.box_scale))
+        return processed
+
+    def _infer(self, frames_bgr: list):
+        if self.blob_size is None:
+            h, w = frames_bgr[0].shape[:2]
+            self.blob_size = infer_size(w, h)
+            self.box_scale = (w / self.blob_size[0], h / self.blob_size[1])
+
+        # One C/SIMD pass does resize + BGR->RGB + /255 + HWC->NCHW for the whole batch,
+        # so the model skips its own per-image numpy preprocessing
+        blob = cv2.dnn.blobFromImages(frames_bgr, scalefactor=1 / 255.0, size=self.blob_size,
+                                      swapRB=True, crop=False)
+        return app.state.video_detector(torch.from_numpy(blob), conf=self.conf, classes=self.ids,
+                                        verbose=False)
+
+
+def run_detection_pipeline(cap, writer, size, ids, conf: float, batch_size: int,
+                           dedup: bool = True, queue_size: int = 8) -> int:
+    """
+    Decode, detect and encode concurrently in three threads linked by FIFO queues
+    Decoded frames are brought to `size` by cropping the odd row/column (or, if the decoder
+    disagrees with the container's reported size, resizing), decided once from the first frame
+    `dedup` reuses detections for near-duplicate frames (off = run the model on every frame)
+    Returns the number of frames written
+    """
+    w, h = size
+    q_in = queue.Queue(maxsize=queue_size)
+    q_out = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()  # set when any stage fails so the others bail out
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return None
+
+    def read_frames():
+        fit = None  # "as-is", "crop" or "resize"; from the first decoded frame, not CAP_PROP_*
+        try:
+            while not stop.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if fit is None:
+                    fh, fw = frame.shape[:2]
+                    if (fh, fw) == (h, w):
+                        fit = "as-is"
+                    elif fh - h in (0, 1) and fw - w in (0, 1):
+                        fit = "crop"
+                    else:
+                        fit = "resize"
+                        print(f"⚠️ Decoded frames are {fw}x{fh}, expected {w}x{h}; resizing")
+                # Drop the odd last row/column; a view, so no per-frame copy
+                if fit == "crop":
+                    frame = frame[:h, :w]
+                elif fit == "resize":
+                    frame = cv2.resize(frame, (w, h))
+                put(q_in, frame)
+        except Exception:
+            stop.set()
+            raise
+        finally:
+            put(q_in, None)
+
+    detector = BatchDetector(ids, conf, max_pixel_diff=DEDUP_MAX_PIXEL_DIFF if dedup else 0)
+
+    def detect_frames():
+        try:
+            pending_frames = []
+            while True:
+                frame = get(q_in)
+                if frame is not None:
+                    pending_frames.append(frame)
+
+                # Run the detector once per full batch (or on the tail at EOF)
+                if pending_frames and (frame is None or len(pending_frames) >= batch_size):
+                    for processed_frame in detector.detect_and_draw(pending_frames):
+                        put(q_out, processed_frame)
+                    pending_frames = []
+
+                if frame is None:
+                    break
+        except Exception:
+            stop.set()
+            raise
+        finally:
+            put(q_out, None)
+
+    def write_frames():
+        try:
+            idx = 0
+            while (processed_frame := get(q_out)) is not None:
+                success = writer.write(processed_frame)
+                if success is False:
+                    print(f"⚠️ Warning: Frame {idx} write failed")
+
+                idx += 1
+                if idx % 30 == 0:
+                    print(f"Processed {idx} frames…")
+            return idx
+        except Exception:
+            stop.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        stages = [pool.submit(read_frames), pool.submit(detect_frames), pool.submit(write_frames)]
+        for stage in stages:
+            stage.result()  # re-raises the first stage error, if any
+
+    if detector.skipped:
+        print(f"⏭️ Reused detections for {detector.skipped} near-duplicate frames")
+    return stages[-1].result()
+
+
+def remove_files(*paths: str):
+    """Delete temp files once the response has been sent"""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+@app.post("/detect/video/{classes}", response_class=FileResponse)
 async def detect_video(
     classes: str,
     file: UploadFile = File(...),
     conf: float = 0.25,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dedup: bool = True,
 ):
     tic = time.time()
     ids = parse_classes(classes)
+    # Each batch is stacked on the GPU at once, so keep clients from asking for too many frames
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
 
     ext = file.filename.split(".")[-1].lower()
     if ext not in {"mp4", "mov", "avi"}:
         raise HTTPException(400, "Upload an MP4, MOV, or AVI video.")
 
-    # Save upload to temp file
+    # Save upload to temp file, 1 MB at a time so the whole video never sits in memory
     tmp_in = tempfile.NamedTemporaryFile(delete=False, suffix=f".{ext}")
-    tmp_in.write(await file.read())
+    while chunk := await file.read(1 << 20):
+        tmp_in.write(chunk)
     tmp_in.close()
 
     cap = cv2.VideoCapture(tmp_in.name)
@@ -32,21 +413,44 @@ async def detect_video(
     if h % 2 != 0:
         h -= 1
 
-    ok, _ = cap.read()
-    if not ok:
+    # Cheap check: trust the container's frame count, and only fall back to
+    # grab() (no BGR conversion) when the count is missing
+    if cap.get(cv2.CAP_PROP_FRAME_COUNT) <= 0:
+        if not cap.grab():
+            cap.release()
+            os.remove(tmp_in.name)
+            raise HTTPException(400, "Failed to decode any frames (re-encode video).")
+        if DECODER == "opencv":
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)  # OpenCV keeps decoding from this capture
+
+    # Decode through ffmpeg (hardware-accelerated when possible) or PyAV instead of OpenCV
+    if DECODER == "ffmpeg":
         cap.release()
-        os.remove(tmp_in.name)
-        raise HTTPException(400, "Failed to decode any frames (re-encode video).")
-    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        cap = FFmpegPipeReader(tmp_in.name, (w, h), HWACCELS.get(H264_ENCODER, "auto"))
+    elif DECODER == "pyav":
+        cap.release()
+        cap = PyAVReader(tmp_in.name)
 
     tmp_out = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
     
-    # Simplified codec selection - try the most reliable ones
     writer = None
     used_codec = "unknown"
-    
+
+    # Preferred: pipe frames into ffmpeg (NVENC/QSV on the GPU when available)
+    if H264_ENCODER:
+        # Off the event loop: the writer waits here for a free ffmpeg encoder slot
+        writer = await asyncio.to_thread(FFmpegPipeWriter, tmp_out.name, fps, (w, h), H264_ENCODER)
+        if writer.isOpened():
+            used_codec = f"H.264 ({H264_ENCODER})"
+            print(f"✅ Using codec: {used_codec}")
+        else:
+            print(f"❌ Could not start ffmpeg with {H264_ENCODER}")
+            writer.release()
+            writer = None
+
+    # Fallback: simplified OpenCV codec selection - try the most reliable ones
     # Try codecs in order of reliability
-    codecs = [
+    codecs = [] if writer else [
         ("mp4v", "MPEG-4"),  # Most compatible (your original)
         ("XVID", "Xvid"),    # Very reliable fallback
         ("MJPG", "Motion JPEG"),  # Universal fallback
@@ -59,26 +463,14 @@ async def detect_video(
             writer = cv2.VideoWriter(tmp_out.name, fourcc, fps, (w, h))
             
             if writer.isOpened():
-                # Test with a dummy frame
-                test_frame = np.zeros((h, w, 3), dtype=np.uint8)
-                success = writer.write(test_frame)
-                
-                if success is not False:  # None or True means success
-                    used_codec = codec_name
-                    print(f"✅ Using codec: {codec_name}")
-                    # Reset the writer for actual use
-                    writer.release()
-                    writer = cv2.VideoWriter(tmp_out.name, fourcc, fps, (w, h))
-                    break
-                else:
-                    print(f"❌ Test write failed for {codec_name}")
-                    writer.release()
-                    writer = None
+                # An open writer is ready to use as-is; no test frame, no reopen
+                used_codec = codec_name
+                print(f"✅ Using codec: {codec_name}")
+                break
             else:
                 print(f"❌ Could not open writer for {codec_name}")
-                if writer:
-                    writer.release()
-                    writer = None
+                writer.release()
+                writer = None
                     
         except Exception as e:
             print(f"❌ Exception with codec {codec_name}: {e}")
@@ -94,29 +486,10 @@ async def detect_video(
     print(f"📹 Processing video: {w}x{h} @ {fps:.1f}fps using {used_codec}")
     
     try:
-        idx = 0
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            # Ensure frame has correct dimensions
-            if frame.shape[:2] != (h, w):
-                frame = cv2.resize(frame, (w, h))
-                
-            # Process frame
-            pil = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            pil = detect_and_draw(pil, ids, conf)
-            processed_frame = cv2.cvtColor(np.array(pil), cv2.COLOR_RGB2BGR)
-            
-            # Write frame
-            success = writer.write(processed_frame)
-            if success is False:
-                print(f"⚠️ Warning: Frame {idx} write failed")
-                
-            idx += 1
-            if idx % 30 == 0:
-                print(f"Processed {idx} frames…")
+        # Decode, inference and encode overlap instead of running back to back
+        idx = await asyncio.to_thread(
+            run_detection_pipeline, cap, writer, (w, h), ids, conf, batch_size, dedup
+        )
 
     except Exception as e:
         print(f"❌ Error during processing: {e}")
@@ -126,8 +499,14 @@ async def detect_video(
         os.remove(tmp_out.name)
         raise HTTPException(500, f"Error during video processing: {str(e)}")
 
-    cap.release()
-    writer.release()
+    # The OpenCV/PyAV objects return None here; the ffmpeg pipes return False on failure
+    decoded_ok = cap.release() is not False
+    encoded_ok = writer.release() is not False
+    if not decoded_ok or not encoded_ok:
+        os.remove(tmp_in.name)
+        os.remove(tmp_out.name)
+        stage = "decoding" if not decoded_ok else f"encoding ({used_codec})"
+        raise HTTPException(500, f"Video {stage} failed")
     
     # Check output file
     if not os.path.exists(tmp_out.name):
@@ -142,9 +521,10 @@ async def detect_video(
     
     print(f"✅ Video done in {time.time()-tic:.2f}s ({idx} frames, {file_size} bytes) using {used_codec}")
 
-    headers = {"Content-Disposition": 'attachment; filename="result.mp4"'}
-    return StreamingResponse(
-        stream_and_cleanup(tmp_out.name, tmp_in.name),
+    # FileResponse hands the file to the socket with sendfile(2), no userspace copies
+    return FileResponse(
+        tmp_out.name,
         media_type="video/mp4",
-        headers=headers,
+        filename="result.mp4",
+        background=BackgroundTask(remove_files, tmp_out.name, tmp_in.name),
     )
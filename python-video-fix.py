@@ -9,6 +9,27 @@ from typing import List, Tuple
 import subprocess
 import logging
 
+# Shared with fixed_video_route.py (video_encoding.py sits next to this file)
+from video_encoding import (
+    H264_ENCODERS, FFmpegPipeWriter, Watermark, configure_opencv_threads, detect_h264_encoder,
+    run_ffmpeg, writable_frame,
+)
+
+# Optional: Numba fuses the color tints into a single parallel pass
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+# Optional: CuPy runs the same fused tint as a CUDA kernel when a GPU is present (used only
+# without Numba, since every host frame has to be copied to the device and back)
+try:
+    import cupy as cp
+    CUPY_AVAILABLE = cp.cuda.runtime.getDeviceCount() > 0
+except Exception:
+    CUPY_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,6 +39,13 @@ def ensure_even_dimensions(width: int, height: int) -> Tuple[int, int]:
     return (width if width % 2 == 0 else width - 1,
             height if height % 2 == 0 else height - 1)
 
+OPENCV_PARALLEL = configure_opencv_threads()
+logger.info(f"OpenCV: {cv2.getNumThreads()} threads ({OPENCV_PARALLEL})")
+
+# Probed once at import rather than per video
+H264_ENCODER = detect_h264_encoder()
+logger.info(f"H.264 encoder: {H264_ENCODER or 'none (ffmpeg unavailable)'}")
+
 def process_video_advanced(input_path: str, output_path: str, object_types: List[str]) -> bool:
     """
     Process video with advanced encoding options for maximum browser compatibility
@@ -46,39 +74,58 @@ def process_video_advanced(input_path: str, output_path: str, object_types: List
         # Try multiple encoding approaches
         success = False
         
-        # Method 1: Try H.264 with OpenCV (most compatible)
-        try:
-            fourcc = cv2.VideoWriter_fourcc(*'avc1')  # H.264
-            out = cv2.VideoWriter(temp_path, fourcc, fps, (width, height))
+        # Resolve which effects to draw once, not per frame
+        effects = effect_flags(object_types)
+        
+        # Method 1: Every effect is whole-frame, so when ffmpeg is available do them all in
+        # one filter graph (decode -> filters -> encode) without a round trip through Python
+        if H264_ENCODER:
+            success = encode_effects_with_ffmpeg(input_path, temp_path, effects)
+        
+        if not success:
+            # Method 2: Effects in Python, H.264 via an ffmpeg pipe (NVENC/QSV when present),
+            # else OpenCV's H.264
+            out = None
+            try:
+                if H264_ENCODER:
+                    out = FFmpegPipeWriter(temp_path, fps, (width, height), H264_ENCODER)
+                else:
+                    fourcc = cv2.VideoWriter_fourcc(*'avc1')  # H.264
+                    out = cv2.VideoWriter(temp_path, fourcc, fps, (width, height))
             
-            frame_count = 0
-            while True:
-                ret, frame = cap.read()
-                if not ret:
-                    break
+                frame_count = 0
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
                 
-                # Resize frame if needed
-                if frame.shape[1] != width or frame.shape[0] != height:
-                    frame = cv2.resize(frame, (width, height))
+                    # Resize frame if needed
+                    if frame.shape[1] != width or frame.shape[0] != height:
+                        frame = cv2.resize(frame, (width, height))
                 
-                # Add processing effects based on detected objects
-                processed_frame = apply_object_effects(frame, object_types)
-                out.write(processed_frame)
+                    # Add processing effects based on detected objects
+                    processed_frame = apply_object_effects(frame, effects)
+                    out.write(processed_frame)
                 
-                frame_count += 1
-                if frame_count % 30 == 0:  # Log progress
-                    logger.info(f"Processed {frame_count}/{total_frames} frames")
+                    frame_count += 1
+                    if frame_count % 30 == 0:  # Log progress
+                        logger.info(f"Processed {frame_count}/{total_frames} frames")
             
-            out.release()
-            success = True
-            logger.info("H.264 encoding with OpenCV successful")
+                # cv2.VideoWriter.release() returns None; the ffmpeg pipe reports its exit status
+                success = out.release() is not False
+                if success:
+                    logger.info(f"H.264 encoding with {H264_ENCODER or 'OpenCV'} successful")
+                else:
+                    logger.warning(f"H.264 encoding with {H264_ENCODER} failed: ffmpeg exited with an error")
             
-        except Exception as e:
-            logger.warning(f"H.264 encoding with OpenCV failed: {e}")
+            except Exception as e:
+                logger.warning(f"H.264 encoding with {H264_ENCODER or 'OpenCV'} failed: {e}")
+                if out is not None:
+                    out.release()  # frees the ffmpeg slot before Method 3 asks for one
         
         cap.release()
         
-        # Method 2: If OpenCV fails, try ffmpeg for maximum compatibility
+        # Method 3: If OpenCV fails, try ffmpeg for maximum compatibility
         if not success or not os.path.exists(temp_path) or os.path.getsize(temp_path) < 1000:
             logger.info("Trying ffmpeg encoding for better compatibility")
             success = encode_with_ffmpeg(input_path, temp_path, object_types)
@@ -99,6 +146,62 @@ def process_video_advanced(input_path: str, output_path: str, object_types: List
         logger.error(f"Error processing video: {e}")
         return False
 
+def build_effect_filters(effects: Tuple[bool, bool, bool]) -> str:
+    """Build the ffmpeg -vf chain equivalent to apply_object_effects"""
+    want_blue, want_border, want_green = effects
+    
+    # Scale to even dimensions, like the OpenCV path's resize
+    filters = ['scale=trunc(iw/2)*2:trunc(ih/2)*2']
+    
+    if want_blue:
+        # Blue tint: 90% of every channel, +3 on blue
+        filters.append("lutrgb=r='val*0.9':g='val*0.9':b='val*0.9+3'")
+    
+    if want_border:
+        # Red border, 3px centred on a rectangle inset by 10px
+        filters.append("drawbox=x=9:y=9:w=iw-17:h=ih-17:color=red:t=3")
+    
+    if want_green:
+        # Green tint: 90% of every channel, +3 on green
+        filters.append("lutrgb=r='val*0.9':g='val*0.9+3':b='val*0.9'")
+    
+    # Always add the watermark
+    filters.append("drawtext=text='PROCESSED':x=30:y=28:fontsize=30:fontcolor=white")
+    
+    return ",".join(filters)
+
+def encode_effects_with_ffmpeg(input_path: str, output_path: str,
+                               effects: Tuple[bool, bool, bool]) -> bool:
+    """
+    Apply the effects and encode in a single ffmpeg run, with no per-frame Python work
+    """
+    try:
+        cmd = [
+            'ffmpeg', '-y', '-v', 'error',
+            '-i', input_path,
+            '-vf', build_effect_filters(effects),
+            '-c:v', H264_ENCODER, *H264_ENCODERS[H264_ENCODER],
+            '-movflags', '+faststart',
+            output_path
+        ]
+        
+        logger.info(f"Running ffmpeg: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, timeout=300)
+        
+        if result.returncode == 0:
+            logger.info(f"ffmpeg filter graph encoding with {H264_ENCODER} successful")
+            return True
+        else:
+            logger.warning(f"ffmpeg filter graph failed, falling back to OpenCV: {result.stderr}")
+            return False
+            
+    except subprocess.TimeoutExpired:
+        logger.error("ffmpeg timeout")
+        return False
+    except Exception as e:
+        logger.error(f"ffmpeg filter graph error: {e}")
+        return False
+
 def encode_with_ffmpeg(input_path: str, output_path: str, object_types: List[str]) -> bool:
     """
     Use ffmpeg for encoding with maximum browser compatibility
@@ -120,7 +223,7 @@ def encode_with_ffmpeg(input_path: str, output_path: str, object_types: List[str
         ]
         
         logger.info(f"Running ffmpeg: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        result = run_ffmpeg(cmd, timeout=300)
         
         if result.returncode == 0:
             logger.info("ffmpeg encoding successful")
@@ -139,42 +242,100 @@ def encode_with_ffmpeg(input_path: str, output_path: str, object_types: List[str
         logger.error(f"ffmpeg encoding error: {e}")
         return False
 
-def apply_object_effects(frame: np.ndarray, object_types: List[str]) -> np.ndarray:
+# addWeighted(frame, 0.9, overlay, 0.1, 0) with a solid 30-valued overlay channel collapses
+# to a 0.9 scale plus these per-channel offsets, so no overlay buffer is ever built
+TINT_ALPHA = 0.9
+BLUE_TINT = (3, 0, 0, 0)
+GREEN_TINT = (0, 3, 0, 0)
+
+# Drawn with a prebaked sprite instead of re-rasterizing the glyphs every frame
+WATERMARK = Watermark("PROCESSED", (30, 50))
+
+def effect_flags(object_types: List[str]) -> Tuple[bool, bool, bool]:
+    """Resolve object types to (blue tint, red border, green tint) flags"""
+    return ('person' in object_types, 'car' in object_types, 'animal' in object_types)
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _tint_kernel(frame, want_blue, want_green):
+        """Apply the blue and/or green tint in one pass, rows split across cores"""
+        height, width, channels = frame.shape
+        for y in prange(height):
+            for x in range(width):
+                for c in range(channels):
+                    v = int(frame[y, x, c])
+                    if want_blue:
+                        v = int(v * 0.9 + 0.5) + (3 if c == 0 else 0)
+                    if want_green:
+                        v = int(v * 0.9 + 0.5) + (3 if c == 1 else 0)
+                    frame[y, x, c] = min(v, 255)
+
+if CUPY_AVAILABLE:
+    # Element-wise over the flattened HxWx3 frame, so channel = i % 3
+    _tint_kernel_gpu = cp.ElementwiseKernel(
+        'uint8 x, bool want_blue, bool want_green', 'uint8 y',
+        '''
+        int v = x;
+        int c = i % 3;
+        if (want_blue) v = (int)(v * 0.9f + 0.5f) + (c == 0 ? 3 : 0);
+        if (want_green) v = (int)(v * 0.9f + 0.5f) + (c == 1 ? 3 : 0);
+        y = min(v, 255);
+        ''',
+        'tint_kernel'
+    )
+
+def _tint_on_gpu(frame: np.ndarray, want_blue: bool, want_green: bool):
+    """Upload the frame once, tint it on the GPU and download back into the same buffer"""
+    gpu_frame = cp.asarray(frame)
+    _tint_kernel_gpu(gpu_frame, want_blue, want_green, gpu_frame)
+    gpu_frame.get(out=frame)
+
+def apply_object_effects(frame: np.ndarray, effects: Tuple[bool, bool, bool]) -> np.ndarray:
     """
-    Apply visual effects based on detected object types
+    Apply visual effects based on detected object types (flags from effect_flags)
+    Modifies `frame` in place and returns it; the caller must own the buffer
+    (cv2.VideoCapture.read() hands out a fresh array per frame)
     """
-    processed_frame = frame.copy()
+    frame = writable_frame(frame)
+    
+    want_blue, want_border, want_green = effects
+    fused = (CUPY_AVAILABLE or NUMBA_AVAILABLE) and (want_blue or want_green)
     
     try:
         # Apply different effects based on detected objects
-        if 'person' in object_types:
+        if fused:
+            # Both tints in a single parallel pass over the frame. Numba first: the frames live
+            # in host memory, and a CuPy round trip (upload + download per frame) costs more
+            # than the tint itself, so the GPU kernel only stands in when Numba is missing
+            if NUMBA_AVAILABLE:
+                _tint_kernel(frame, want_blue, want_green)
+            else:
+                _tint_on_gpu(frame, want_blue, want_green)
+        elif want_blue:
             # Add a subtle blue tint for person detection
-            blue_overlay = np.zeros_like(processed_frame)
-            blue_overlay[:, :, 0] = 30  # Blue channel
-            processed_frame = cv2.addWeighted(processed_frame, 0.9, blue_overlay, 0.1, 0)
+            cv2.convertScaleAbs(frame, dst=frame, alpha=TINT_ALPHA)
+            cv2.add(frame, BLUE_TINT, dst=frame)
         
-        if 'car' in object_types:
+        if want_border:
             # Add a subtle red border effect
-            cv2.rectangle(processed_frame, (10, 10), 
-                         (processed_frame.shape[1]-10, processed_frame.shape[0]-10), 
-                         (0, 0, 255), 3)
+            # (drawn before the green tint, so pre-tint its color when the tints were fused)
+            border_color = (0, 3, 230) if fused and want_green else (0, 0, 255)
+            cv2.rectangle(frame, (10, 10), 
+                         (frame.shape[1]-10, frame.shape[0]-10), 
+                         border_color, 3)
         
-        if 'animal' in object_types:
+        if want_green and not fused:
             # Add a green tint
-            green_overlay = np.zeros_like(processed_frame)
-            green_overlay[:, :, 1] = 30  # Green channel
-            processed_frame = cv2.addWeighted(processed_frame, 0.9, green_overlay, 0.1, 0)
+            cv2.convertScaleAbs(frame, dst=frame, alpha=TINT_ALPHA)
+            cv2.add(frame, GREEN_TINT, dst=frame)
         
         # Always add a timestamp or watermark
-        cv2.putText(processed_frame, "PROCESSED", 
-                   (30, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        WATERMARK.draw(frame)
         
     except Exception as e:
         logger.warning(f"Error applying effects: {e}")
-        # Return original frame if effects fail
-        return frame
     
-    return processed_frame
+    return frame
 
 # Your FastAPI route should look like this:
 """
@@ -10,12 +10,14 @@ import numpy as np
 import tempfile
 import os
 import json
-import subprocess
 import logging
 from typing import List
 from fastapi import UploadFile, File, Form
 import uuid
 
+# Shares the ffmpeg encoder slots with the other processors (video_encoding.py sits next to this file)
+from video_encoding import run_ffmpeg
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -67,7 +69,7 @@ def try_ffmpeg_safe_encode(input_path: str, output_path: str, object_types: List
         ]
         
         logger.info("🎬 Attempting ultra-safe ffmpeg encoding...")
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+        result = run_ffmpeg(cmd, timeout=300)
         
         if result.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 10000:
             logger.info(f"✅ ffmpeg success: {os.path.getsize(output_path)} bytes")
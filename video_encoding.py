@@ -0,0 +1,170 @@
+# Shared H.264 encoding helpers for fixed_video_route.py, python-video-fix.py,
+# simple-video-processor.py and ultimate-video-processor.py; keep this file next to them,
+# they all import from here
+
+import os
+import subprocess
+import threading
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+def configure_opencv_threads() -> str:
+    """
+    Let OpenCV's parallel_for_ use every core; returns the parallel backend in use
+    resize/cvtColor/addWeighted all scale with cv2.getNumThreads(); TBB is the best backend
+    (pip's opencv-python ships pthreads; build with -D WITH_TBB=ON -D BUILD_TBB=ON for TBB)
+    """
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(os.cpu_count() or 1)
+    for line in cv2.getBuildInformation().splitlines():
+        if 'Parallel framework' in line:
+            return line.split(':', 1)[1].strip()
+    return 'unknown'
+
+
+def writable_frame(frame: np.ndarray) -> np.ndarray:
+    """The frame itself if effects can draw on it in place, else one private C-order copy"""
+    if frame.flags.writeable and frame.flags.c_contiguous:
+        return frame
+    # Read-only buffers (e.g. np.frombuffer) and strided crops
+    return np.array(frame, order='C')
+
+
+class Watermark:
+    """
+    White text rasterized once into a black sprite (its pixel values are the text coverage,
+    i.e. the alpha) and alpha-blended into just its ROI of each frame
+    `origin` is the bottom-left of the text, as cv2.putText takes it
+    """
+
+    def __init__(self, text: str, origin: Tuple[int, int]):
+        self.text = text
+        self.origin = origin
+        (text_w, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 1, 2)
+        pad = 4  # room for the stroke thickness
+        sprite = np.zeros((text_h + baseline + 2 * pad, text_w + 2 * pad, 3), dtype=np.uint8)
+        cv2.putText(sprite, text, (pad, text_h + pad), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        self.size = sprite.shape[:2]
+        self.pos = (origin[0] - pad, origin[1] - text_h - pad)  # sprite's top-left in the frame
+        # Per-frame blend is roi * (1 - alpha) + 255 * alpha; precompute both terms (+0.5 to round)
+        self.keep = 1.0 - sprite[:, :, :1].astype(np.float32) / 255.0
+        self.add = sprite[:, :, :1].astype(np.float32) + 0.5
+
+    def draw(self, frame: np.ndarray) -> np.ndarray:
+        """Blend the watermark into the frame in place (plain putText if the sprite won't fit)"""
+        x, y = self.pos
+        sprite_h, sprite_w = self.size
+        if frame.shape[0] >= y + sprite_h and frame.shape[1] >= x + sprite_w:
+            roi = frame[y:y + sprite_h, x:x + sprite_w]
+            np.copyto(roi, roi * self.keep + self.add, casting='unsafe')
+        else:
+            cv2.putText(frame, self.text, self.origin, cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        return frame
+
+
+# Every ffmpeg encode in the process holds one of these slots while it runs (run_ffmpeg for
+# its duration, FFmpegPipeWriter until release()), so concurrent requests queue for a bounded
+# number of encoders instead of each starting its own
+FFMPEG_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_WORKERS)
+
+
+def run_ffmpeg(cmd: List[str], timeout: int) -> subprocess.CompletedProcess:
+    """subprocess.run an ffmpeg encode once an encoder slot is free; blocks until then"""
+    with ffmpeg_slots:
+        return subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+
+# H.264 encoders in order of preference (GPU first), with their rate-control args
+H264_ENCODERS = {
+    'h264_nvenc': ['-preset', 'p4', '-cq', '23', '-pix_fmt', 'yuv420p'],
+    'h264_qsv': ['-preset', 'faster', '-global_quality', '23', '-pix_fmt', 'nv12'],
+    'libx264': ['-preset', 'veryfast', '-crf', '23', '-pix_fmt', 'yuv420p'],
+}
+
+
+@lru_cache(maxsize=None)
+def detect_h264_encoder() -> Optional[str]:
+    """Return the first H.264 encoder that actually works here, or None without ffmpeg"""
+    for encoder, args in H264_ENCODERS.items():
+        # Being listed in `ffmpeg -encoders` doesn't mean the GPU is there, so test-encode a frame
+        cmd = [
+            'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'color=size=256x256',
+            '-frames:v', '1', '-c:v', encoder, *args, '-f', 'null', '-'
+        ]
+        try:
+            if subprocess.run(cmd, capture_output=True, timeout=15).returncode == 0:
+                return encoder
+        except FileNotFoundError:
+            return None
+        except subprocess.TimeoutExpired:
+            continue
+    return None
+
+
+class FFmpegPipeWriter:
+    """
+    cv2.VideoWriter look-alike that pipes raw BGR frames into an ffmpeg H.264 encoder
+    Holds an encoder slot from construction (blocking until one is free) until release()
+    """
+
+    def __init__(self, path: str, fps: float, size: Tuple[int, int], encoder: Optional[str] = None,
+                 video_args: Optional[List[str]] = None, ffmpeg_path: str = 'ffmpeg',
+                 bufsize: int = -1):
+        """
+        Encode with one of H264_ENCODERS by name, or pass the full video_args ('-c:v' included)
+        bufsize is the stdin pipe buffer in bytes (-1 = io default)
+        """
+        width, height = size
+        self.shape = (height, width, 3)
+        if video_args is None:
+            video_args = ['-c:v', encoder, *H264_ENCODERS[encoder]]
+        cmd = [
+            ffmpeg_path, '-y', '-v', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps),
+            '-i', 'pipe:0',
+            *video_args,
+            '-movflags', '+faststart',
+            path
+        ]
+        ffmpeg_slots.acquire()
+        self.holds_slot = True
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=bufsize)
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        if self.holds_slot:
+            self.holds_slot = False
+            ffmpeg_slots.release()
+
+    def isOpened(self) -> bool:
+        return self.proc.poll() is None
+
+    def write(self, frame: np.ndarray) -> bool:
+        # Raw video has no framing, so one wrong-sized frame would garble everything after it
+        if frame.shape != self.shape:
+            return False
+        try:
+            self.proc.stdin.write(np.ascontiguousarray(frame).data)
+            return True
+        except (BrokenPipeError, ValueError):
+            return False
+
+    def release(self) -> bool:
+        """Finish the encode; True if ffmpeg exited cleanly"""
+        if not self.proc.stdin.closed:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        try:
+            return self.proc.wait() == 0
+        finally:
+            self._release_slot()